@@ -0,0 +1,414 @@
+# coord.py — общее состояние для нескольких реплик бота (кеш листов, lease лидера, отметки ежедневных задач)
+# Only stdlib here (redis is imported lazily), so this module can be used and tested without Telegram/Sheets.
+import json
+import logging
+import sqlite3
+import threading
+import time as _time
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# ---------- Coordination backends ----------
+# Small key-value store shared by replicas: string values with optional TTL, atomic set-if-absent,
+# owner-checked lease renew/release, counters and prefix reads. The leader lease is renewed from a
+# background thread, so the local backends lock around every operation.
+# `durable` tells whether marks survive a restart (catch-up of missed daily jobs relies on that).
+class MemoryCoordBackend:
+    """In-process stand-in (single replica / tests). Lost on restart."""
+    durable = False
+
+    def __init__(self):
+        self._data = {}  # key -> (value, expires_at or None)
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        entry = self._data.get(key)
+        if entry and entry[1] is not None and entry[1] <= _time.time():
+            self._data.pop(key, None)
+            return None
+        return entry
+
+    def _set(self, key, value, ttl_seconds):
+        self._data[key] = (value, _time.time() + ttl_seconds if ttl_seconds else None)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key)
+            return entry[0] if entry else None
+
+    def get_prefix(self, prefix):
+        with self._lock:
+            return {k: e[0] for k in list(self._data) if k.startswith(prefix) for e in [self._live(k)] if e}
+
+    def set(self, key, value, ttl_seconds=None):
+        with self._lock:
+            self._set(key, value, ttl_seconds)
+
+    def set_if_absent(self, key, value, ttl_seconds=None):
+        with self._lock:
+            if self._live(key):
+                return False
+            self._set(key, value, ttl_seconds)
+            return True
+
+    def renew_if_owner(self, key, value, ttl_seconds):
+        with self._lock:
+            entry = self._live(key)
+            if not entry or entry[0] != value:
+                return False
+            self._set(key, value, ttl_seconds)
+            return True
+
+    def release_if_owner(self, key, value):
+        with self._lock:
+            entry = self._live(key)
+            if not entry or entry[0] != value:
+                return False
+            self._data.pop(key, None)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            entry = self._live(key)
+            val = int(entry[0] if entry else 0) + 1
+            self._set(key, str(val), None)
+            return val
+
+class SqliteCoordBackend:
+    """SQLite file shared by replicas on one host (tests / local runs)."""
+    durable = True
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+
+    def _purge(self, key):
+        self._conn.execute("DELETE FROM kv WHERE key = ? AND expires IS NOT NULL AND expires <= ?", (key, _time.time()))
+
+    def _transaction(self, fn):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return result
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM kv WHERE key = ? AND (expires IS NULL OR expires > ?)", (key, _time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_prefix(self, prefix):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, value FROM kv WHERE substr(key, 1, ?) = ? AND (expires IS NULL OR expires > ?)",
+                (len(prefix), prefix, _time.time()),
+            ).fetchall()
+        return dict(rows)
+
+    def set(self, key, value, ttl_seconds=None):
+        expires = _time.time() + ttl_seconds if ttl_seconds else None
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)", (key, value, expires))
+
+    def set_if_absent(self, key, value, ttl_seconds=None):
+        expires = _time.time() + ttl_seconds if ttl_seconds else None
+        def insert():
+            self._purge(key)
+            cur = self._conn.execute("INSERT OR IGNORE INTO kv (key, value, expires) VALUES (?, ?, ?)", (key, value, expires))
+            return cur.rowcount == 1
+        return self._transaction(insert)
+
+    def renew_if_owner(self, key, value, ttl_seconds):
+        now = _time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE kv SET expires = ? WHERE key = ? AND value = ? AND (expires IS NULL OR expires > ?)",
+                (now + ttl_seconds, key, value, now),
+            )
+        return cur.rowcount == 1
+
+    def release_if_owner(self, key, value):
+        with self._lock:
+            cur = self._conn.execute("DELETE FROM kv WHERE key = ? AND value = ?", (key, value))
+        return cur.rowcount == 1
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def incr(self, key):
+        def bump():
+            self._purge(key)
+            row = self._conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+            val = int(row[0]) + 1 if row else 1
+            self._conn.execute("INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, NULL)", (key, str(val)))
+            return val
+        return self._transaction(bump)
+
+class RedisCoordBackend:
+    """Redis (or any Redis-compatible store) shared by all replicas."""
+    durable = True
+    _RENEW_SCRIPT = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end"
+    )
+    _RELEASE_SCRIPT = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('del', KEYS[1]) else return 0 end"
+    )
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("COORD_BACKEND_URL is a redis:// URL but the 'redis' package is not installed")
+        self._r = redis.Redis.from_url(url, decode_responses=True)
+        self._renew = self._r.register_script(self._RENEW_SCRIPT)
+        self._release = self._r.register_script(self._RELEASE_SCRIPT)
+
+    def get(self, key):
+        return self._r.get(key)
+
+    def get_prefix(self, prefix):
+        keys = list(self._r.scan_iter(match=prefix + "*"))
+        if not keys:
+            return {}
+        return {k: v for k, v in zip(keys, self._r.mget(keys)) if v is not None}
+
+    def set(self, key, value, ttl_seconds=None):
+        self._r.set(key, value, px=int(ttl_seconds * 1000) if ttl_seconds else None)
+
+    def set_if_absent(self, key, value, ttl_seconds=None):
+        return bool(self._r.set(key, value, nx=True, px=int(ttl_seconds * 1000) if ttl_seconds else None))
+
+    def renew_if_owner(self, key, value, ttl_seconds):
+        return bool(self._renew(keys=[key], args=[value, int(ttl_seconds * 1000)]))
+
+    def release_if_owner(self, key, value):
+        return bool(self._release(keys=[key], args=[value]))
+
+    def delete(self, key):
+        self._r.delete(key)
+
+    def incr(self, key):
+        return int(self._r.incr(key))
+
+def make_coord_backend(url):
+    if not url:
+        return None
+    if url.startswith("memory://"):
+        return MemoryCoordBackend()
+    if url.startswith("sqlite:///"):
+        return SqliteCoordBackend(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCoordBackend(url)
+    raise RuntimeError("Unsupported COORD_BACKEND_URL: " + url)
+
+# ---------------------------------------------
+
+# ---------- Sheet read-cache ----------
+# local cache structure: { sheet_title: (timestamp, data) }
+# With a backend the cache lives in the shared store instead, so an invalidation after a write is
+# seen by every replica. Each sheet has a generation counter bumped on invalidation; an entry is only
+# used if it was fetched under the current generation (a slow read can't resurrect stale data).
+# If the backend is unreachable reads fall back to the local cache, never straight to the Sheets API.
+SHEET_RECORDS_CACHE = {}
+CACHE_TTL_SECONDS = 60  # increased TTL to 60s to avoid Read-request bursts causing 429
+
+def cached_get_all_records(sheet_obj, ttl_seconds=CACHE_TTL_SECONDS, backend=None):
+    if backend is not None:
+        try:
+            return shared_cached_get_all_records(backend, sheet_obj, ttl_seconds)
+        except Exception:
+            logger.exception("Shared cache unavailable for " + sheet_obj.title + ", using local cache")
+    title = sheet_obj.title
+    now = _time.time()
+    entry = SHEET_RECORDS_CACHE.get(title)
+    if entry:
+        ts, data = entry
+        if now - ts < ttl_seconds:
+            return data
+    # fetch fresh
+    data = sheet_obj.get_all_records()
+    SHEET_RECORDS_CACHE[title] = (now, data)
+    return data
+
+def shared_cached_get_all_records(backend, sheet_obj, ttl_seconds=CACHE_TTL_SECONDS):
+    """Raises if the backend can't be read, so the caller can fall back to the local cache."""
+    title = sheet_obj.title
+    gen = backend.get("sheetgen:" + title) or "0"
+    raw = backend.get("sheetcache:" + title)
+    if raw:
+        entry = json.loads(raw)
+        if entry.get("gen") == gen:
+            return entry["data"]
+    data = sheet_obj.get_all_records()
+    try:
+        backend.set("sheetcache:" + title, json.dumps({"gen": gen, "data": data}), ttl_seconds)
+    except Exception:
+        logger.exception("Shared cache write failed for " + title)
+    return data
+
+def invalidate_sheet_cache_by_title(sheet_title, backend=None):
+    if sheet_title in SHEET_RECORDS_CACHE:
+        SHEET_RECORDS_CACHE.pop(sheet_title, None)
+    if backend is not None:
+        try:
+            backend.incr("sheetgen:" + sheet_title)
+            backend.delete("sheetcache:" + sheet_title)
+        except Exception:
+            logger.exception("Shared cache invalidation failed for " + sheet_title)
+
+# ---------------------------------------------
+
+# ---------- Leases / once-per-day runs ----------
+def hold_lease(backend, key, owner, ttl_seconds):
+    """Renew the lease if `owner` holds it, else try to acquire it. Returns True if `owner` holds it now."""
+    return backend.renew_if_owner(key, owner, ttl_seconds) or backend.set_if_absent(key, owner, ttl_seconds)
+
+class LeaseKeeper:
+    """
+    Keeps a lease renewed from its own thread, so a bot event loop blocked on synchronous Sheets calls
+    can't let it expire. held() stays True until the last successful renewal is ttl_seconds old, so a
+    backend hiccup doesn't demote a leader that still owns the lease; a refused renewal (lease expired or
+    taken over) demotes at once. on_lost is called from the thread once the lease is gone.
+    """
+    def __init__(self, backend, key, owner, ttl_seconds, clock=_time.monotonic):
+        self.backend = backend
+        self.key = key
+        self.owner = owner
+        self.ttl_seconds = ttl_seconds
+        self.lost = False
+        self._clock = clock
+        self._renewed_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def renew(self):
+        """Try to acquire/renew once. Returns True while the lease is (still) ours."""
+        started = self._clock()  # measured before the call: the backend's TTL started no earlier
+        try:
+            ok = hold_lease(self.backend, self.key, self.owner, self.ttl_seconds)
+        except Exception:
+            logger.exception("Failed to renew lease " + self.key)
+            return self.held()
+        self._renewed_at = started if ok else None
+        return ok
+
+    def held(self):
+        return self._renewed_at is not None and self._clock() - self._renewed_at < self.ttl_seconds
+
+    def start(self, on_lost):
+        def loop():
+            while not self._stop.wait(self.ttl_seconds / 3):
+                if not self.renew():
+                    self.lost = True
+                    logger.warning(f"Lease {self.key} lost by {self.owner}")
+                    on_lost()
+                    return
+        self._thread = threading.Thread(target=loop, name="lease-" + self.key, daemon=True)
+        self._thread.start()
+
+    def stop(self, release=True):
+        """Stop renewing; on a graceful stop hand the lease over right away instead of letting it expire."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        if release and not self.lost:
+            try:
+                self.backend.release_if_owner(self.key, self.owner)
+            except Exception:
+                logger.exception("Failed to release lease " + self.key)
+        self._renewed_at = None
+
+def claim_daily_run(backend, name, day_iso, owner):
+    """Mark job `name` as run for `day_iso`; False if some replica already did. Claimed before running,
+    so a crash mid-run skips that day rather than sending duplicates."""
+    try:
+        return backend.set_if_absent(f"dailyrun:{name}:{day_iso}", owner, 2 * 24 * 3600)
+    except Exception:
+        logger.exception("Failed to claim daily run " + name)
+        return False
+
+def catch_up_jobs(backend, jobs, now, window_seconds, owner):
+    """
+    Names of daily jobs a new leader should run now: scheduled today no more than window_seconds ago
+    and not claimed yet (claimed here). jobs: [(name, time with tzinfo)], now: aware datetime in that tz.
+    Nothing is caught up on a non-durable backend: its claims don't survive a restart.
+    """
+    if not getattr(backend, "durable", False):
+        return []
+    due = []
+    for name, run_time in jobs:
+        scheduled = datetime.combine(now.date(), run_time.replace(tzinfo=None), tzinfo=now.tzinfo)
+        if not scheduled <= now < scheduled + timedelta(seconds=window_seconds):
+            continue
+        if claim_daily_run(backend, name, now.date().isoformat(), owner):
+            due.append(name)
+    return due
+
+# ---------------------------------------------
+
+# ---------- Conversation persistence ----------
+class ConversationStore:
+    """
+    ConversationHandler states and user_data in the shared backend, one key per user / conversation so
+    writes never overwrite other entries. can_write() is checked before every write: a deposed leader
+    flushing on shutdown must not clobber what the new leader already stored.
+    """
+    USER_PREFIX = "persist:user:"
+
+    def __init__(self, backend, can_write=lambda: True):
+        self.backend = backend
+        self.can_write = can_write
+
+    def _writable(self):
+        if self.can_write():
+            return True
+        logger.info("Not the lease holder, skipping persistence write")
+        return False
+
+    @staticmethod
+    def _conv_prefix(name):
+        return f"persist:conv:{name}:"
+
+    def get_user_data(self):
+        n = len(self.USER_PREFIX)
+        return {int(k[n:]): json.loads(v) for k, v in self.backend.get_prefix(self.USER_PREFIX).items()}
+
+    def update_user_data(self, user_id, data):
+        if self._writable():
+            self.backend.set(self.USER_PREFIX + str(user_id), json.dumps(data))
+
+    def drop_user_data(self, user_id):
+        if self._writable():
+            self.backend.delete(self.USER_PREFIX + str(user_id))
+
+    def get_conversations(self, name):
+        # conversation keys are tuples like (chat_id, user_id); stored as a JSON list in the key
+        prefix = self._conv_prefix(name)
+        return {tuple(json.loads(k[len(prefix):])): json.loads(v) for k, v in self.backend.get_prefix(prefix).items()}
+
+    def update_conversation(self, name, key, new_state):
+        if not self._writable():
+            return
+        k = self._conv_prefix(name) + json.dumps(list(key))
+        if new_state is None:
+            self.backend.delete(k)
+        else:
+            self.backend.set(k, json.dumps(new_state))
+
+# ---------------------------------------------
@@ -1,8 +1,10 @@
 # main.py — финальная версия (с кешированием чтений от Google Sheets) + генератором Actions
 import os
 import json
+import asyncio
 import base64
 import logging
+import socket
 import time as _time
 from datetime import datetime, date, time as dtime, timedelta
 from zoneinfo import ZoneInfo
@@ -10,6 +12,9 @@ from zoneinfo import ZoneInfo
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 
+import coord
+import reconcile
+
 from telegram import (
     Update,
     ReplyKeyboardMarkup,
@@ -18,6 +23,10 @@ from telegram import (
 )
 from telegram.ext import (
     ApplicationBuilder,
+    ApplicationHandlerStop,
+    BasePersistence,
+    PersistenceInput,
+    TypeHandler,
     CommandHandler,
     MessageHandler,
     ConversationHandler,
@@ -31,6 +40,10 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
 GOOGLE_SERVICE_ACCOUNT_B64 = os.getenv("GOOGLE_SERVICE_ACCOUNT_B64")
 PODGORICA_TZ = "Europe/Podgorica"
+# optional shared backend for running several replicas:
+# "" (single replica), "memory://", "sqlite:///path/to/coord.db" or "redis://host:6379/0"
+COORD_BACKEND_URL = os.getenv("COORD_BACKEND_URL", "")
+REPLICA_ID = os.getenv("REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}"
 # ----------------------------
 
 logging.basicConfig(level=logging.INFO)
@@ -61,27 +74,22 @@ subs_sheet = wb.worksheet("Subscribers")
 schedules_sheet = wb.worksheet("Schedules")
 # ---------------------------------------
 
+# ---------- Coordination backend (multi-replica) ----------
+# Shared key-value store for the sheet cache, leader lease and daily-run marks (see coord.py).
+COORD = coord.make_coord_backend(COORD_BACKEND_URL)
+if COORD is not None:
+    logger.info(f"Coordination backend: {type(COORD).__name__}, replica {REPLICA_ID}")
+# ---------------------------------------------
+
 # ---------- Simple sheet read-cache ----------
-# cache structure: { sheet_title: (timestamp, data) }
-SHEET_RECORDS_CACHE = {}
-CACHE_TTL_SECONDS = 60  # increased TTL to 60s to avoid Read-request bursts causing 429
+# lives in coord.py; shared between replicas when COORD is set
+CACHE_TTL_SECONDS = coord.CACHE_TTL_SECONDS
 
 def cached_get_all_records(sheet_obj, ttl_seconds=CACHE_TTL_SECONDS):
-    title = sheet_obj.title
-    now = _time.time()
-    entry = SHEET_RECORDS_CACHE.get(title)
-    if entry:
-        ts, data = entry
-        if now - ts < ttl_seconds:
-            return data
-    # fetch fresh
-    data = sheet_obj.get_all_records()
-    SHEET_RECORDS_CACHE[title] = (now, data)
-    return data
+    return coord.cached_get_all_records(sheet_obj, ttl_seconds, backend=COORD)
 
 def invalidate_sheet_cache_by_title(sheet_title):
-    if sheet_title in SHEET_RECORDS_CACHE:
-        SHEET_RECORDS_CACHE.pop(sheet_title, None)
+    coord.invalidate_sheet_cache_by_title(sheet_title, backend=COORD)
 
 def invalidate_sheet_cache(sheet_obj):
     invalidate_sheet_cache_by_title(sheet_obj.title)
@@ -231,6 +239,90 @@ def generate_actions_for_batch(batch_id, batch_date_iso, cheese_name):
 
 # -------------------------------------
 
+# ---------- Remaining reconciliation ----------
+# Logic lives in reconcile.py; here are the Sheets reads/writes and checkpoint storage.
+RECONCILE_STATE_PATH = os.getenv("RECONCILE_STATE_PATH", "reconcile_state.json")
+BATCHES_REMAINING_COL = 6  # F
+
+def load_reconcile_checkpoint():
+    """Return the saved checkpoint state, or None (full rescan)."""
+    try:
+        if COORD is not None:
+            # shared checkpoint, so a new leader continues where the previous one stopped
+            raw = COORD.get("reconcile:checkpoint")
+            return reconcile.normalize_state(json.loads(raw) if raw else None)
+        with open(RECONCILE_STATE_PATH, "r", encoding="utf-8") as f:
+            return reconcile.normalize_state(json.load(f))
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logger.exception("Failed to read reconcile checkpoint, doing full rescan")
+        return None
+
+def save_reconcile_checkpoint(state):
+    tmp_path = RECONCILE_STATE_PATH + ".tmp"
+    try:
+        if COORD is not None:
+            COORD.set("reconcile:checkpoint", json.dumps(state))
+            return
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, RECONCILE_STATE_PATH)
+    except Exception:
+        logger.exception("Failed to save reconcile checkpoint")
+
+def read_sales_from(sales_row):
+    """
+    Read Sales rows starting at the checkpoint row itself (always inside the grid, unlike sales_row + 1
+    when nothing was appended). Returns (checkpoint row values, rows after it).
+    """
+    rows = sales_sheet.get(f"A{sales_row}:F")
+    if not rows:
+        return [], []
+    return list(rows[0]), rows[1:]
+
+def write_remaining_fixes(fixes):
+    updates = [
+        {"range": gspread.utils.rowcol_to_a1(m["Row"], BATCHES_REMAINING_COL), "values": [[m["Expected"]]]}
+        for m in fixes
+    ]
+    batches_sheet.batch_update(updates)
+    invalidate_sheet_cache(batches_sheet)
+
+def reconcile_remaining(apply_fixes=True, full=False):
+    """
+    Compare Batches.Remaining with Quantity - sum(Sales qty) for every BatchID.
+    Returns (mismatches, fixed): lists of dicts {BatchID, Row, Remaining, Expected}; see reconcile.run_reconcile.
+    """
+    mismatches, fixed, state = reconcile.run_reconcile(
+        read_batches=batches_sheet.get_all_records,  # not the cache: the cached copy is exactly what may be stale
+        read_sales_from=read_sales_from,
+        write_fixes=write_remaining_fixes,
+        state=load_reconcile_checkpoint(),
+        now_dt=datetime.now(ZoneInfo(PODGORICA_TZ)),
+        apply_fixes=apply_fixes,
+        full=full,
+    )
+    save_reconcile_checkpoint(state)
+    return mismatches, fixed
+
+async def reconcile_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        # blocking Sheets reads (a full Sales rescan can be long) — keep them off the event loop
+        mismatches, fixed = await asyncio.to_thread(reconcile_remaining, True)
+    except Exception:
+        logger.exception("Exception in reconcile_job")
+        return
+    if fixed:
+        logger.warning(f"Reconcile: fixed {len(fixed)} Remaining mismatches: {fixed}")
+    skipped = [m for m in mismatches if m not in fixed]
+    if skipped:
+        logger.warning(f"Reconcile: {len(skipped)} mismatches not fixed (recent sales or malformed Sales rows): {skipped}")
+    if not mismatches:
+        logger.info("Reconcile: Batches.Remaining matches Sales")
+
+# -------------------------------------
+
 # ---------- Handlers ----------
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -622,9 +714,132 @@ async def callback_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         pass
 
+# ---------- Leader election / daily jobs ----------
+# With COORD set, replicas compete for a lease and only the holder runs the bot: Telegram allows a single
+# getUpdates poller per token, so the others wait in main() as standbys. The lease is renewed by a
+# coord.LeaseKeeper thread, independent of the event loop (Sheets calls block it). The leader steps down
+# only once the lease has really expired or was taken over, and releases it on a graceful shutdown.
+# A new leader catches up on daily jobs scheduled less than CATCH_UP_WINDOW_SECONDS ago (durable backends only).
+# Without COORD the single process is always the leader and nothing is caught up on restart.
+LEADER_LEASE_KEY = "leader"
+LEADER_LEASE_SECONDS = 30
+CATCH_UP_WINDOW_SECONDS = 2 * 3600
+LEASE = None  # coord.LeaseKeeper while this replica runs the bot
+
+# (name, run time, callback)
+DAILY_JOBS = [
+    ("daily_notifications", dtime(9, 0, tzinfo=ZoneInfo(PODGORICA_TZ)), send_daily_notifications),
+    ("reconcile", dtime(3, 0, tzinfo=ZoneInfo(PODGORICA_TZ)), reconcile_job),
+]
+
+def is_leader():
+    return COORD is None or (LEASE is not None and LEASE.held())
+
+def claim_daily_run(name, day_iso):
+    if COORD is None:
+        return True
+    return coord.claim_daily_run(COORD, name, day_iso, REPLICA_ID)
+
+def leader_only_daily(name, callback):
+    async def job(context: ContextTypes.DEFAULT_TYPE):
+        if not is_leader():
+            logger.info(f"Not the leader, skipping {name}")
+            return
+        if not claim_daily_run(name, today_iso()):
+            logger.info(f"{name} already ran today on another replica")
+            return
+        await callback(context)
+    return job
+
+async def drop_if_not_leader(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # first handler (group -1): a deposed leader still draining updates must not act on them
+    if not is_leader():
+        logger.warning("Lease lost, ignoring update")
+        raise ApplicationHandlerStop
+
+async def catch_up_daily_jobs(context: ContextTypes.DEFAULT_TYPE):
+    # run once after taking over: daily jobs a previous leader may have missed shortly before
+    now = datetime.now(ZoneInfo(PODGORICA_TZ))
+    jobs = {name: callback for name, _, callback in DAILY_JOBS}
+    due = coord.catch_up_jobs(COORD, [(name, t) for name, t, _ in DAILY_JOBS], now, CATCH_UP_WINDOW_SECONDS, REPLICA_ID)
+    for name in due:
+        if not is_leader():
+            return
+        logger.info(f"Catch-up: running {name}")
+        try:
+            await jobs[name](context)
+        except Exception:
+            logger.exception("Catch-up failed for " + name)
+
+# ---------- Conversation persistence (multi-replica) ----------
+class CoordPersistence(BasePersistence):
+    """
+    PTB persistence on top of coord.ConversationStore: ConversationHandler states and user_data live in
+    COORD, so a replica that takes over continues half-finished /sale and /addbatch flows.
+    Writes are skipped once this replica no longer holds the lease. Chat/bot/callback data are not used.
+    """
+    def __init__(self, store, update_interval=5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = store
+
+    async def get_user_data(self):
+        return self.store.get_user_data()
+
+    async def update_user_data(self, user_id, data):
+        self.store.update_user_data(user_id, data)
+
+    async def drop_user_data(self, user_id):
+        self.store.drop_user_data(user_id)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def get_conversations(self, name):
+        return self.store.get_conversations(name)
+
+    async def update_conversation(self, name, key, new_state):
+        self.store.update_conversation(name, key, new_state)
+
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def flush(self):
+        pass
+
 # ---------- Build and run ----------
 def build_app():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    builder = ApplicationBuilder().token(BOT_TOKEN)
+    if COORD is not None:
+        # conversation state must survive a leader switch
+        builder = builder.persistence(CoordPersistence(coord.ConversationStore(COORD, can_write=is_leader)))
+    app = builder.build()
 
     addbatch_conv = ConversationHandler(
         entry_points=[MessageHandler(filters.Regex("^Сварить сыр$"), addbatch_start), CommandHandler("addbatch", addbatch_start)],
@@ -637,6 +852,8 @@ def build_app():
         },
         fallbacks=[CommandHandler("start", cmd_start)],
         allow_reentry=True,
+        name="addbatch",
+        persistent=COORD is not None,
     )
 
     sale_conv = ConversationHandler(
@@ -652,8 +869,12 @@ def build_app():
         },
         fallbacks=[CommandHandler("start", cmd_start)],
         allow_reentry=True,
+        name="sale",
+        persistent=COORD is not None,
     )
 
+    if COORD is not None:
+        app.add_handler(TypeHandler(Update, drop_if_not_leader), group=-1)
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(addbatch_conv)
     app.add_handler(sale_conv)
@@ -668,25 +889,70 @@ def build_app():
         await update.message.reply_text("Готово. Проверьте сообщения у подписчиков (и у себя).")
     app.add_handler(CommandHandler("check", cmd_check))
 
-    # schedule daily job at 09:00 in Podgorica
-    tz = ZoneInfo(PODGORICA_TZ)
-    # put tzinfo into time object (python-telegram-bot expects tzinfo inside time)
-    run_time = dtime(9, 0, tzinfo=tz)
-
+    # /reconcile — recompute Batches.Remaining from Sales and fix drift
+    # ("/reconcile dry" only reports, "/reconcile full" ignores the checkpoint and rescans all of Sales)
+    async def cmd_reconcile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        args = [a.lower() for a in (context.args or [])]
+        dry = "dry" in args
+        try:
+            mismatches, fixed = await asyncio.to_thread(reconcile_remaining, not dry, "full" in args)
+        except Exception:
+            logger.exception("Failed to reconcile Remaining")
+            await update.message.reply_text("Ошибка сверки остатков.", reply_markup=main_menu_keyboard())
+            return
+        if not mismatches:
+            await update.message.reply_text("Остатки в Batches совпадают с Sales.", reply_markup=main_menu_keyboard())
+            return
+        skipped = [m for m in mismatches if m not in fixed]
+        parts = []
+        if fixed:
+            parts.append("Расхождения исправлены:\n" + "\n".join(f'Batch {m["BatchID"]}: {m["Remaining"]} → {m["Expected"]}' for m in fixed))
+        if skipped:
+            header = "Расхождения (не исправлены):" if dry else "Расхождения (не исправлены: недавние продажи или ошибки в строках Sales):"
+            parts.append(header + "\n" + "\n".join(f'Batch {m["BatchID"]}: {m["Remaining"]} → {m["Expected"]}' for m in skipped))
+        await update.message.reply_text("\n\n".join(parts), reply_markup=main_menu_keyboard())
+    app.add_handler(CommandHandler("reconcile", cmd_reconcile))
+
+    # schedule daily jobs (notifications at 09:00, Remaining reconciliation at 03:00 in Podgorica)
     # PTB v20+ expects tzinfo inside time(...) and doesn't accept timezone= kw
-    app.job_queue.run_daily(
-        send_daily_notifications,
-        time=run_time,
-        days=(0, 1, 2, 3, 4, 5, 6)  # каждый день
-    )
-
-    logger.info(f"Scheduled daily job at {run_time} ({PODGORICA_TZ})")
+    for name, run_time, callback in DAILY_JOBS:
+        app.job_queue.run_daily(
+            leader_only_daily(name, callback),
+            time=run_time,
+            days=(0, 1, 2, 3, 4, 5, 6),  # каждый день
+            name=name,
+        )
+        logger.info(f"Scheduled daily job {name} at {run_time} ({PODGORICA_TZ})")
+
+    if COORD is not None:
+        app.job_queue.run_once(catch_up_daily_jobs, when=1)
     return app
 
 def main():
-    app = build_app()
-    logger.info("Bot starting...")
-    app.run_polling()
+    global LEASE
+    if COORD is None:
+        app = build_app()
+        logger.info("Bot starting...")
+        app.run_polling()
+        return
+    # one replica polls, the rest wait for the leader lease
+    loop = asyncio.get_event_loop()
+    while True:
+        LEASE = coord.LeaseKeeper(COORD, LEADER_LEASE_KEY, REPLICA_ID, LEADER_LEASE_SECONDS)
+        logger.info(f"Replica {REPLICA_ID} waiting for leader lease...")
+        while not LEASE.renew():
+            _time.sleep(LEADER_LEASE_SECONDS / 3)
+        logger.info(f"Replica {REPLICA_ID} is the leader")
+        app = build_app()
+        LEASE.start(on_lost=lambda: loop.call_soon_threadsafe(app.stop_running))
+        try:
+            logger.info("Bot starting...")
+            app.run_polling(close_loop=False)
+        finally:
+            LEASE.stop(release=True)
+        if not LEASE.lost:
+            break  # stopped by a signal, not by losing the lease
+        logger.warning("Lost leader lease, back to standby")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,143 @@
+# reconcile.py — сверка Batches.Remaining с Sales
+# Batches.Remaining is decremented by read-modify-write in the sale handlers; if something fails between
+# Sales.append_row and update_cell the two sheets drift apart. The reconciler recomputes
+# Remaining = Quantity - sum(Sales qty) per BatchID and fixes mismatches with one batch_update.
+# Per-batch sums are checkpointed, so each run only reads Sales rows added since the previous run.
+# Edits to already-processed Sales rows aren't visible to that, so the checkpoint is dropped and Sales
+# rescanned in full every FULL_RESCAN_DAYS (or on "/reconcile full").
+# Sheet access is passed in by main.py, so this module needs only the stdlib and can be tested on its own.
+import logging
+from datetime import date, datetime
+
+logger = logging.getLogger(__name__)
+
+GRACE_SECONDS = 120  # don't touch batches with a sale this fresh — its Remaining update may still be in flight
+FULL_RESCAN_DAYS = 7
+SALES_BATCHID_IDX = 1  # Sales row: [Date, BatchID, Qty, "", Who, Timestamp]
+SALES_QTY_IDX = 2
+SALES_TS_IDX = 5
+
+def empty_state(today_iso):
+    """Checkpoint before any Sales row is processed (row 1 = header)."""
+    return {"sales_row": 1, "last_row_values": [], "sums": {}, "bad": [], "full_scan_date": today_iso}
+
+def normalize_state(raw):
+    """Checkpoint as loaded from JSON -> state dict, or None if missing/unusable (forces a full rescan)."""
+    if not raw:
+        return None
+    try:
+        return {
+            "sales_row": int(raw.get("sales_row", 1)),
+            "last_row_values": list(raw.get("last_row_values") or []),
+            "sums": {str(k): int(v) for k, v in (raw.get("sums") or {}).items()},
+            "bad": [str(b) for b in (raw.get("bad") or [])],
+            "full_scan_date": raw.get("full_scan_date"),
+        }
+    except Exception:
+        logger.exception("Unusable reconcile checkpoint, doing full rescan")
+        return None
+
+def full_rescan_due(state, today_iso, full_rescan_days=FULL_RESCAN_DAYS):
+    try:
+        last_full = date.fromisoformat(state["full_scan_date"])
+    except Exception:
+        return True
+    return (date.fromisoformat(today_iso) - last_full).days >= full_rescan_days
+
+def is_recent_sale(ts_value, now_dt, grace_seconds=GRACE_SECONDS):
+    try:
+        ts = datetime.strptime(str(ts_value), "%Y-%m-%d %H:%M:%S").replace(tzinfo=now_dt.tzinfo)
+    except Exception:
+        return False
+    return (now_dt - ts).total_seconds() < grace_seconds
+
+def apply_sales_rows(state, rows, now_dt, grace_seconds=GRACE_SECONDS):
+    """
+    Add Sales rows (those after state["sales_row"]) to the per-batch sums and advance the checkpoint.
+    Batches with a malformed row (e.g. Qty "1,5" or "2 шт") go to state["bad"] and are never auto-fixed
+    until a full rescan no longer finds such a row. Returns the set of BatchIDs with a sale inside the grace window.
+    """
+    sums = state["sums"]
+    bad = set(state["bad"])
+    recent = set()
+    for i, r in enumerate(rows, start=state["sales_row"] + 1):
+        if not any(str(v).strip() for v in r):
+            continue
+        bid = str(r[SALES_BATCHID_IDX]).strip() if len(r) > SALES_BATCHID_IDX else ""
+        try:
+            qty = int(r[SALES_QTY_IDX])
+        except Exception:
+            qty = None
+        if not bid:
+            logger.warning(f"Reconcile: Sales row {i} has no BatchID, ignored: {r}")
+            continue
+        if qty is None:
+            logger.warning(f"Reconcile: Sales row {i} has unreadable Qty, batch {bid} won't be auto-fixed: {r}")
+            bad.add(bid)
+            continue
+        sums[bid] = sums.get(bid, 0) + qty
+        if len(r) > SALES_TS_IDX and is_recent_sale(r[SALES_TS_IDX], now_dt, grace_seconds):
+            recent.add(bid)
+    if rows:
+        state["sales_row"] += len(rows)
+        state["last_row_values"] = list(rows[-1])
+    state["bad"] = sorted(bad)
+    return recent
+
+def find_mismatches(batches, sums):
+    """batches: Batches records (row 2 first). Returns [{BatchID, Row, Remaining, Expected}] for rows that disagree."""
+    mismatches = []
+    for idx, b in enumerate(batches, start=2):
+        bid = str(b.get("BatchID") or "").strip()
+        if not bid or bid == "None":
+            continue  # blank / partial row
+        try:
+            quantity = int(b.get("Quantity") or 0)
+        except Exception:
+            continue
+        expected = max(quantity - sums.get(bid, 0), 0)
+        try:
+            remaining = int(b.get("Remaining"))
+        except Exception:
+            remaining = None
+        if remaining != expected:
+            mismatches.append({"BatchID": bid, "Row": idx, "Remaining": b.get("Remaining"), "Expected": expected})
+    return mismatches
+
+def run_reconcile(read_batches, read_sales_from, write_fixes, state, now_dt, apply_fixes=True, full=False,
+                  grace_seconds=GRACE_SECONDS, full_rescan_days=FULL_RESCAN_DAYS):
+    """
+    One reconciliation pass.
+    read_batches() -> Batches records; read_sales_from(row) -> (values of that row, rows after it);
+    write_fixes(mismatches) writes Expected into Remaining in one batch.
+    Returns (mismatches, fixed, new_state). Mismatches not in `fixed` were skipped: dry run, a sale within
+    the grace window or a malformed Sales row for that batch.
+    """
+    today = now_dt.date().isoformat()
+    # read Batches first: any decrement visible here then belongs to a Sales row read below,
+    # so a sale still in flight is covered by the grace window
+    batches = read_batches()
+
+    if state is None or full or full_rescan_due(state, today, full_rescan_days):
+        logger.info("Reconcile: full Sales rescan")
+        state = empty_state(today)
+    checkpoint_row, new_rows = read_sales_from(state["sales_row"])
+    # checkpoint is only valid if the row it stopped at is still the same (rows may have been deleted/edited)
+    if state["sales_row"] > 1 and checkpoint_row != state["last_row_values"]:
+        logger.info("Sales changed before checkpoint row %s, doing full rescan", state["sales_row"])
+        state = empty_state(today)
+        checkpoint_row, new_rows = read_sales_from(1)
+
+    recent = apply_sales_rows(state, new_rows, now_dt, grace_seconds)
+    mismatches = find_mismatches(batches, state["sums"])
+
+    fixed = []
+    if apply_fixes:
+        skip = recent | set(state["bad"])
+        fixed = [m for m in mismatches if m["BatchID"] not in skip]
+        if fixed:
+            write_fixes(fixed)
+            logger.info(f"Reconcile: fixed Remaining for {len(fixed)} batches")
+        if len(fixed) < len(mismatches):
+            logger.info(f"Reconcile: skipped {len(mismatches) - len(fixed)} batches (recent sales or malformed Sales rows)")
+    return mismatches, fixed, state
@@ -0,0 +1,256 @@
+import threading
+import time
+from datetime import datetime, time as dtime, timedelta, timezone
+
+import pytest
+
+import coord
+
+
+class FakeSheet:
+    """Stands in for a gspread worksheet: counts reads, optionally runs a hook mid-read."""
+    def __init__(self, title, records):
+        self.title = title
+        self.records = records
+        self.reads = 0
+        self.during_read = None
+
+    def get_all_records(self):
+        self.reads += 1
+        data = list(self.records)
+        if self.during_read:
+            hook, self.during_read = self.during_read, None
+            hook()
+        return data
+
+
+class BrokenBackend:
+    def __getattr__(self, name):
+        def fail(*args, **kwargs):
+            raise ConnectionError("backend down")
+        return fail
+
+
+@pytest.fixture(autouse=True)
+def clear_local_cache():
+    coord.SHEET_RECORDS_CACHE.clear()
+    yield
+    coord.SHEET_RECORDS_CACHE.clear()
+
+
+@pytest.fixture
+def two_sqlite_replicas(tmp_path):
+    path = str(tmp_path / "coord.db")
+    return coord.SqliteCoordBackend(path), coord.SqliteCoordBackend(path)
+
+
+def test_sqlite_lease_is_exclusive_across_connections(two_sqlite_replicas):
+    a, b = two_sqlite_replicas
+    assert a.set_if_absent("leader", "replica-a", 1)
+    assert not b.set_if_absent("leader", "replica-b", 1)
+    assert b.get("leader") == "replica-a"
+
+    assert a.renew_if_owner("leader", "replica-a", 1)
+    assert not b.renew_if_owner("leader", "replica-b", 1)
+
+
+def test_sqlite_lease_expires_and_can_be_taken_over(two_sqlite_replicas):
+    a, b = two_sqlite_replicas
+    assert a.set_if_absent("leader", "replica-a", 0.2)
+    time.sleep(0.3)
+    assert b.get("leader") is None
+    assert not a.renew_if_owner("leader", "replica-a", 1)  # expired lease can't be renewed
+    assert coord.hold_lease(b, "leader", "replica-b", 1)
+    assert not coord.hold_lease(a, "leader", "replica-a", 1)
+
+
+def test_shared_cache_serves_second_replica(two_sqlite_replicas):
+    a, b = two_sqlite_replicas
+    sheet = FakeSheet("Batches", [{"BatchID": 1}])
+    assert coord.cached_get_all_records(sheet, backend=a) == [{"BatchID": 1}]
+    assert coord.cached_get_all_records(sheet, backend=b) == [{"BatchID": 1}]
+    assert sheet.reads == 1
+
+
+def test_invalidation_drops_entry_cached_under_old_generation(two_sqlite_replicas):
+    a, b = two_sqlite_replicas
+    sheet = FakeSheet("Batches", [{"BatchID": 1, "Remaining": 5}])
+    # replica b writes (and invalidates) while replica a's read is still in flight
+    def concurrent_write():
+        sheet.records = [{"BatchID": 1, "Remaining": 4}]
+        coord.invalidate_sheet_cache_by_title("Batches", backend=b)
+    sheet.during_read = concurrent_write
+
+    assert coord.cached_get_all_records(sheet, backend=a) == [{"BatchID": 1, "Remaining": 5}]
+    # the stale result a stored was fetched under the old generation and must not be served
+    assert coord.cached_get_all_records(sheet, backend=b) == [{"BatchID": 1, "Remaining": 4}]
+    assert sheet.reads == 2
+
+
+def test_backend_outage_falls_back_to_local_cache():
+    sheet = FakeSheet("Actions", [{"BatchID": 1}])
+    backend = BrokenBackend()
+    for _ in range(3):
+        assert coord.cached_get_all_records(sheet, backend=backend) == [{"BatchID": 1}]
+    assert sheet.reads == 1
+
+
+def test_claim_daily_run_once_per_day(two_sqlite_replicas):
+    a, b = two_sqlite_replicas
+    assert coord.claim_daily_run(a, "daily_notifications", "2026-10-19", "replica-a")
+    assert not coord.claim_daily_run(b, "daily_notifications", "2026-10-19", "replica-b")
+    assert not coord.claim_daily_run(a, "daily_notifications", "2026-10-19", "replica-a")
+    # other jobs and other days are independent
+    assert coord.claim_daily_run(b, "reconcile", "2026-10-19", "replica-b")
+    assert coord.claim_daily_run(b, "daily_notifications", "2026-10-20", "replica-b")
+
+
+def test_claim_daily_run_refuses_when_backend_down():
+    assert not coord.claim_daily_run(BrokenBackend(), "daily_notifications", "2026-10-19", "replica-a")
+
+
+def test_memory_backend_incr_and_delete():
+    m = coord.MemoryCoordBackend()
+    assert m.incr("sheetgen:Sales") == 1
+    assert m.incr("sheetgen:Sales") == 2
+    m.delete("sheetgen:Sales")
+    assert m.get("sheetgen:Sales") is None
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FlakyBackend(coord.MemoryCoordBackend):
+    """Memory backend whose calls can be made to fail, like a Redis outage."""
+    def __init__(self):
+        super().__init__()
+        self.down = False
+
+    def renew_if_owner(self, *args):
+        if self.down:
+            raise ConnectionError("backend down")
+        return super().renew_if_owner(*args)
+
+    def set_if_absent(self, *args):
+        if self.down:
+            raise ConnectionError("backend down")
+        return super().set_if_absent(*args)
+
+
+def test_sqlite_release_only_by_owner_and_prefix_reads(two_sqlite_replicas):
+    a, b = two_sqlite_replicas
+    assert a.set_if_absent("leader", "replica-a", 30)
+    assert not b.release_if_owner("leader", "replica-b")
+    assert a.release_if_owner("leader", "replica-a")
+    assert b.set_if_absent("leader", "replica-b", 30)
+
+    a.set("persist:user:1", "x")
+    b.set("persist:user:2", "y")
+    b.set("persist:users", "not this one")
+    assert b.get_prefix("persist:user:") == {"persist:user:1": "x", "persist:user:2": "y"}
+
+
+def test_backend_failure_steps_down_only_after_lease_expires():
+    backend, clock = FlakyBackend(), FakeClock()
+    keeper = coord.LeaseKeeper(backend, "leader", "replica-a", 30, clock=clock)
+    assert keeper.renew()
+
+    backend.down = True
+    clock.now += 10
+    assert keeper.renew() and keeper.held()
+    clock.now += 19
+    assert keeper.renew()
+    clock.now += 1  # 30s since the last successful renewal
+    assert not keeper.renew()
+    assert not keeper.held()
+
+
+def test_refused_renewal_steps_down_at_once():
+    backend, clock = coord.MemoryCoordBackend(), FakeClock()
+    keeper = coord.LeaseKeeper(backend, "leader", "replica-a", 30, clock=clock)
+    assert keeper.renew()
+    backend.set("leader", "replica-b", 30)  # taken over, e.g. after a long pause
+    assert not keeper.renew()
+    assert not keeper.held()
+
+
+def test_lease_released_on_graceful_stop_but_not_after_loss():
+    backend = coord.MemoryCoordBackend()
+    keeper = coord.LeaseKeeper(backend, "leader", "replica-a", 30)
+    assert keeper.renew()
+    keeper.stop(release=True)
+    assert backend.get("leader") is None
+
+    keeper = coord.LeaseKeeper(backend, "leader", "replica-a", 30)
+    assert keeper.renew()
+    keeper.lost = True
+    backend.set("leader", "replica-b", 30)
+    keeper.stop(release=True)
+    assert backend.get("leader") == "replica-b"
+
+
+def test_lease_thread_reports_loss():
+    backend = coord.MemoryCoordBackend()
+    keeper = coord.LeaseKeeper(backend, "leader", "replica-a", 0.3)
+    assert keeper.renew()
+    lost = threading.Event()
+    keeper.start(on_lost=lost.set)
+    backend.set("leader", "replica-b", 30)
+    assert lost.wait(2)
+    assert keeper.lost
+    keeper.stop()
+
+
+TZ = timezone(timedelta(hours=2))
+JOBS = [("reconcile", dtime(3, 0, tzinfo=TZ)), ("daily_notifications", dtime(9, 0, tzinfo=TZ))]
+
+
+def test_catch_up_only_inside_window(two_sqlite_replicas):
+    a, _ = two_sqlite_replicas
+    assert coord.catch_up_jobs(a, JOBS, datetime(2026, 10, 19, 2, 0, tzinfo=TZ), 7200, "replica-a") == []
+    assert coord.catch_up_jobs(a, JOBS, datetime(2026, 10, 19, 4, 30, tzinfo=TZ), 7200, "replica-a") == ["reconcile"]
+    assert coord.catch_up_jobs(a, JOBS, datetime(2026, 10, 20, 23, 0, tzinfo=TZ), 7200, "replica-a") == []
+
+
+def test_catch_up_skips_claimed_jobs(two_sqlite_replicas):
+    a, b = two_sqlite_replicas
+    assert coord.claim_daily_run(a, "daily_notifications", "2026-10-19", "replica-a")
+    now = datetime(2026, 10, 19, 9, 30, tzinfo=TZ)
+    assert coord.catch_up_jobs(b, JOBS, now, 7200, "replica-b") == []
+
+
+def test_no_catch_up_on_memory_backend():
+    now = datetime(2026, 10, 19, 9, 5, tzinfo=TZ)
+    assert coord.catch_up_jobs(coord.MemoryCoordBackend(), JOBS, now, 7200, "replica-a") == []
+
+
+def test_conversation_store_round_trip(two_sqlite_replicas):
+    a, b = two_sqlite_replicas
+    writer = coord.ConversationStore(a)
+    writer.update_conversation("sale", (123, 456), 107)
+    writer.update_conversation("sale", (123, 789), 101)
+    writer.update_conversation("sale", (123, 789), None)
+    writer.update_conversation("addbatch", (5, 6), 2)
+    writer.update_user_data(456, {"batchid": 12, "cheese": "Качотта"})
+    writer.update_user_data(789, {})
+    writer.drop_user_data(789)
+
+    reader = coord.ConversationStore(b)
+    assert reader.get_conversations("sale") == {(123, 456): 107}
+    assert reader.get_conversations("addbatch") == {(5, 6): 2}
+    assert reader.get_user_data() == {456: {"batchid": 12, "cheese": "Качотта"}}
+
+
+def test_conversation_store_skips_writes_without_lease():
+    backend = coord.MemoryCoordBackend()
+    coord.ConversationStore(backend).update_conversation("sale", (1, 1), 104)
+    deposed = coord.ConversationStore(backend, can_write=lambda: False)
+    deposed.update_conversation("sale", (1, 1), None)
+    deposed.update_user_data(1, {"qty": 3})
+    assert coord.ConversationStore(backend).get_conversations("sale") == {(1, 1): 104}
+    assert coord.ConversationStore(backend).get_user_data() == {}
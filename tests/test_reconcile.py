@@ -0,0 +1,127 @@
+from datetime import datetime, timedelta, timezone
+
+import reconcile
+
+NOW = datetime(2026, 10, 19, 3, 0, tzinfo=timezone.utc)
+OLD_TS = "2026-10-18 12:00:00"
+HEADER = ["Date", "BatchID", "Qty", "", "Who", "Timestamp"]
+
+
+def sale(bid, qty, ts=OLD_TS):
+    return ["2026-10-18", str(bid), str(qty), "", "anna", ts]
+
+
+class FakeSheets:
+    """Batches records + Sales rows (row 1 = header) behind the callables run_reconcile expects."""
+    def __init__(self, batches, sales):
+        self.batches = batches
+        self.sales = [HEADER] + sales
+        self.sales_reads = []
+        self.writes = []
+
+    def read_batches(self):
+        return [dict(b) for b in self.batches]
+
+    def read_sales_from(self, row):
+        self.sales_reads.append(row)
+        rows = self.sales[row - 1:]
+        if not rows:
+            return [], []
+        return list(rows[0]), [list(r) for r in rows[1:]]
+
+    def write_fixes(self, fixes):
+        self.writes.append(fixes)
+        for m in fixes:
+            self.batches[m["Row"] - 2]["Remaining"] = m["Expected"]
+
+    def run(self, state, **kwargs):
+        return reconcile.run_reconcile(self.read_batches, self.read_sales_from, self.write_fixes, state, kwargs.pop("now_dt", NOW), **kwargs)
+
+
+def batch(bid, quantity, remaining):
+    return {"BatchID": bid, "Quantity": quantity, "Remaining": remaining}
+
+
+def test_incremental_run_matches_full_rescan():
+    sheets = FakeSheets([batch(1, 10, 10), batch(2, 5, 5)], [sale(1, 2), sale(2, 1)])
+    _, _, state = sheets.run(None, apply_fixes=False)
+    sheets.sales += [sale(1, 3), sale(2, 4)]
+    incremental, _, inc_state = sheets.run(state, apply_fixes=False)
+    assert sheets.sales_reads[-1] == 3  # continued from the checkpoint row
+
+    full, _, full_state = sheets.run(None, apply_fixes=False)
+    assert incremental == full
+    assert inc_state["sums"] == full_state["sums"] == {"1": 5, "2": 5}
+    assert inc_state["sales_row"] == full_state["sales_row"] == 5
+
+
+def test_changed_checkpoint_row_forces_rescan():
+    sheets = FakeSheets([batch(1, 10, 7)], [sale(1, 2), sale(1, 1)])
+    _, _, state = sheets.run(None, apply_fixes=False)
+    sheets.sales[2] = sale(1, 5)  # last processed row edited
+    mismatches, _, state = sheets.run(state, apply_fixes=False)
+    assert sheets.sales_reads[-2:] == [3, 1]
+    assert state["sums"] == {"1": 7}
+    assert mismatches == [{"BatchID": "1", "Row": 2, "Remaining": 7, "Expected": 3}]
+
+
+def test_sale_inside_grace_window_is_not_fixed():
+    fresh = (NOW - timedelta(seconds=30)).strftime("%Y-%m-%d %H:%M:%S")
+    sheets = FakeSheets([batch(1, 10, 10), batch(2, 10, 10)], [sale(1, 2, ts=fresh), sale(2, 3)])
+    mismatches, fixed, _ = sheets.run(None)
+    assert [m["BatchID"] for m in mismatches] == ["1", "2"]
+    assert [m["BatchID"] for m in fixed] == ["2"]
+    assert sheets.batches[0]["Remaining"] == 10
+    assert sheets.batches[1]["Remaining"] == 7
+
+
+def test_dry_run_writes_nothing():
+    sheets = FakeSheets([batch(1, 10, 10)], [sale(1, 4)])
+    mismatches, fixed, _ = sheets.run(None, apply_fixes=False)
+    assert len(mismatches) == 1
+    assert fixed == []
+    assert sheets.writes == []
+
+
+def test_weekly_full_rescan():
+    sheets = FakeSheets([batch(1, 10, 8)], [sale(1, 2)])
+    _, _, state = sheets.run(None)
+    assert state["full_scan_date"] == "2026-10-19"
+
+    later = NOW + timedelta(days=reconcile.FULL_RESCAN_DAYS - 1)
+    _, _, state = sheets.run(state, now_dt=later)
+    assert sheets.sales_reads[-1] == 2
+    assert state["full_scan_date"] == "2026-10-19"
+
+    later = NOW + timedelta(days=reconcile.FULL_RESCAN_DAYS)
+    _, _, state = sheets.run(state, now_dt=later)
+    assert sheets.sales_reads[-1] == 1
+    assert state["full_scan_date"] == later.date().isoformat()
+
+
+def test_malformed_sales_row_blocks_fix_for_that_batch():
+    sheets = FakeSheets([batch(1, 10, 7), batch(2, 10, 10)], [sale(1, 2), sale(1, "1,5"), sale(2, 1)])
+    mismatches, fixed, state = sheets.run(None)
+    assert state["bad"] == ["1"]
+    assert [m["BatchID"] for m in mismatches] == ["1", "2"]
+    assert [m["BatchID"] for m in fixed] == ["2"]
+    assert sheets.batches[0]["Remaining"] == 7
+
+    # still blocked on the next incremental run, when the bad row is behind the checkpoint
+    sheets.sales.append(sale(2, 1))
+    _, fixed, _ = sheets.run(state)
+    assert [m["BatchID"] for m in fixed] == ["2"]
+
+
+def test_blank_batch_rows_are_ignored():
+    sheets = FakeSheets([batch(1, 10, 10), batch("", "", ""), {"BatchID": None}], [sale(1, 1), ["", "", "", "", "", ""]])
+    mismatches, fixed, _ = sheets.run(None)
+    assert [m["Row"] for m in mismatches] == [2]
+    assert [m["Row"] for m in fixed] == [2]
+
+
+def test_normalize_state_rejects_garbage():
+    assert reconcile.normalize_state(None) is None
+    assert reconcile.normalize_state({"sales_row": "x"}) is None
+    state = reconcile.normalize_state({"sales_row": 4, "sums": {1: "3"}})
+    assert state["sums"] == {"1": 3} and state["bad"] == []